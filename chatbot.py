@@ -1,165 +1,497 @@
 import os
-from openai import OpenAI
-import speech_recognition as sr
-import pyttsx3
+import asyncio
+import functools
+import json
+import logging
+import pathlib
+import queue
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import httpx
+from openai import AsyncOpenAI
 import configparser
 import memory_manager
-import traceback
 from dotenv import load_dotenv
+try:
+    import tiktoken
+except ImportError: # Optional: without it, token counts are estimated from message length
+    tiktoken = None
+try:
+    import h2 # noqa: F401 (only needed so httpx can negotiate HTTP/2)
+    HTTP2_AVAILABLE = True
+except ImportError: # Optional: without it, the client stays on HTTP/1.1 keep-alive
+    HTTP2_AVAILABLE = False
 load_dotenv() # This loads the variables from .env into your environment
 
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY")) # This line will now fetch your key
-engine = pyttsx3.init() # Initialize PyTTS engine
-recognizer = sr.Recognizer()
-microphone = sr.Microphone()
-
-SETTINGS_FILE = os.path.abspath("settings.ini") # Locate settings file
-SYSTEM_PROMPT_FILE = os.path.abspath("system_prompt.txt")
-
-def process_chatbot_message(message: str) -> str:
+logger = logging.getLogger("kinecho.chatbot")
+
+# Shared async client: one keep-alive connection pool for every interface, so concurrent chats don't serialize or re-handshake
+client = AsyncOpenAI(
+    api_key=os.getenv("OPENAI_API_KEY"), # This line will now fetch your key
+    http_client=httpx.AsyncClient(
+        http2=HTTP2_AVAILABLE, # Multiplexes concurrent requests (chat, summaries, batches) over one connection
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=60.0)
+    )
+)
+# Audio objects are created on first use, so Discord/console-only runs never load PortAudio or the TTS driver
+engine = None # PyTTS engine, see _get_engine()
+recognizer = None # See _get_recognizer()
+microphone = None # See _get_microphone()
+mic_source = None # Open microphone stream reused across listens, see _get_mic_source()
+mic_calibrated_at = None # time.monotonic() of the last ambient noise calibration
+MIC_RECALIBRATE_INTERVAL = 60 # Seconds before the noise threshold is re-measured, so it follows changes in background noise
+
+PROJECT_DIR = pathlib.Path(__file__).resolve().parent # Resolved once, and independent of the working directory Kinecho is launched from
+SETTINGS_FILE = PROJECT_DIR / "settings.ini" # Locate settings file
+SYSTEM_PROMPT_FILE = PROJECT_DIR / "system_prompt.txt"
+# Sent as a separate message right after the (static) system prompt
+USER_CONTEXT_PROMPT = (
+    "You are currently conversing with {user_name}. When this user asks you for their identity or personal information "
+    "that has been provided in this context (like their name), you are permitted and encouraged to acknowledge it. "
+    "Please do not claim ignorance of information you've been given if at all possible. Please do not confuse this user with others."
+)
+MAX_HISTORY_MESSAGES = 20 # How many previous messages from the current channel are sent along with each prompt
+MAX_PROMPT_TOKENS = 3000 # Token budget for the system prompt plus replayed history; older messages are dropped past it
+HISTORY_SUMMARY_SLACK = 10 # Once a channel holds this many messages past MAX_HISTORY_MESSAGES, the oldest are summarized in the background
+# (MAX_HISTORY_MESSAGES + HISTORY_SUMMARY_SLACK must stay below memory_manager.MAX_CHANNEL_HISTORY_MESSAGES, or history is trimmed before it's summarized)
+GROUPED_HISTORY_MESSAGES = 6 # Previous messages per user replayed in a grouped request (several users share its prompt, so fewer than MAX_HISTORY_MESSAGES)
+HISTORY_SUMMARY_PROMPT = (
+    "Summarize the earlier part of a conversation between a user and Kinecho, an AI companion, in a short paragraph. "
+    "Keep names, facts about the user, preferences, plans and anything else worth remembering; leave out small talk. "
+    "If a previous summary is given, fold it into the new one."
+)
+HISTORY_SUMMARY_CONTEXT = "Summary of your earlier conversation with this user: {summary}"
+
+CHAT_MODEL = "gpt-4o-mini" # Cheaper per token than gpt-3.5-turbo; OpenAI only prompt-caches prefixes of 1024+ tokens, which the persona prompt alone is well short of
+BATCH_POLL_INTERVAL = 30 # Seconds between status checks of a submitted Batch API job
+
+async def process_chatbot_message(message: str) -> str:
     """
     Processes a message using the chatbot's logic and returns a response.
     (This will eventually contain your main chatbot processing code)
     """
     # Call your existing get_chat_response function with the user's message
-    # For now, we're passing None for history and channel_id,
-    # as we'll integrate memory more properly in a later step.
-    response = get_chat_response(prompt_text=message, history=None, channel_id="test_channel_from_app_main")
+    # There's no real user here, so this runs as the default "anonymous" console user.
+    response = await get_chat_response(prompt_text=message, channel_id="test_channel_from_app_main")
     return response
 
-def load_system_prompt(user_name: str) -> str:
-    try:
+_prompt_template = None # Raw contents of system_prompt.txt, read once and reused across turns
+_prompt_template_mtime = None # mtime of the file when it was last read, so edits are picked up without a restart
+
+def _read_prompt_template() -> str:
+    """
+    Returns the raw system prompt template, only re-reading the file if it changed on disk.
+    """
+    global _prompt_template, _prompt_template_mtime
+    mtime = os.path.getmtime(SYSTEM_PROMPT_FILE)
+    if _prompt_template is None or mtime != _prompt_template_mtime:
         with open(SYSTEM_PROMPT_FILE, "r", encoding="utf-8") as f:
-            # Read the template and format it with the user_name
-            # Note: The placeholder {user_name} must exist in system_prompt.txt
-            prompt_template = f.read()
-            return prompt_template.format(user_name=user_name)
+            _prompt_template = f.read()
+        _prompt_template_mtime = mtime
+    return _prompt_template
+
+def load_system_prompt() -> str:
+    """
+    Returns the persona system prompt. It's the same for every user so it stays a byte-identical
+    prefix across requests, which OpenAI's prompt caching could reuse if the prompt ever grows past
+    its 1024-token minimum; see _user_context_message().
+    """
+    try:
+        return _read_prompt_template()
     except FileNotFoundError:
-        print(f"ERROR: System prompt file not found at {SYSTEM_PROMPT_FILE}. Using default prompt.")
+        logger.error("System prompt file not found at %s. Using default prompt.", SYSTEM_PROMPT_FILE)
         return "You are a helpful AI companion named Kinecho." # Fallback default prompt
-    except KeyError as e:
-        print(f"ERROR: Missing placeholder in system prompt file: {e}. Check system_prompt.txt for {{user_name}}.")
-        return "You are a helpful AI companion named Kinecho." # Fallback if formatting fails (e.g., missing {user_name} placeholder)
     except Exception as e: # Catch any other unexpected errors during prompt loading
-        print(f"ERROR: Unexpected error loading system prompt: {e}")
-        traceback.print_exc()
+        logger.exception("Unexpected error loading system prompt: %s", e)
         return "You are a helpful AI companion named Kinecho."
 
-def get_chat_response(user_id: str, prompt_text: str, channel_id: str, interface_type: str):
-    """
-    Generates a chat response using OpenAI's API.
-    For now, this function will respond without conversational memory.
-    """
-#    print(f"DEBUG: get_chat_response received: user_id={user_id}, prompt='{prompt_text}', channel_id={channel_id}, interface_type={interface_type}")
-
-    memory = {}
-
+@functools.lru_cache(maxsize=1)
+def _get_encoder():
+    # Built once: encoding_for_model parses the whole BPE merge table
+    if tiktoken is None:
+        return None
     try:
-        memory = memory_manager.load_memory() # Load the overall memory structure
-#        print("DEBUG: Memory loaded successfully.")
+        return tiktoken.encoding_for_model(CHAT_MODEL)
     except Exception as e:
-        print(f"ERROR: Failed to load memory: {e}")
-        traceback.print_exc()
-        print("WARNING: Proceeding with empty memory for this request.")
+        logger.warning("Couldn't load tokenizer for %s, estimating token counts instead: %s", CHAT_MODEL, e)
+        return None
 
-    # Retrieve the specific user's data and their events
+def _count_tokens(texts: list) -> list:
+    encoder = _get_encoder()
+    if encoder is None:
+        return [len(text) // 4 + 1 for text in texts] # Roughly 4 characters per token for English text
+    return [len(tokens) for tokens in encoder.encode_batch(texts)]
+
+@functools.lru_cache(maxsize=512)
+def _count_system_prompt_tokens(system_prompt_content: str) -> int:
+    # System prompts repeat every turn, so their count is cached
+    return _count_tokens([system_prompt_content])[0]
+
+def _trim_history_to_budget(system_messages: list, history: list) -> list:
+    """
+    Drops the oldest messages from history until it fits in MAX_PROMPT_TOKENS alongside the system messages.
+    """
+    budget = MAX_PROMPT_TOKENS - sum(_count_system_prompt_tokens(message["content"]) for message in system_messages)
+    token_counts = _count_tokens([message["content"] for message in history])
+    start = len(history)
+    used = 0
+    while start > 0 and used + token_counts[start - 1] <= budget:
+        start -= 1
+        used += token_counts[start]
+    if start < len(history) and history[start]["role"] == "assistant":
+        start += 1 # Don't open the history with a reply whose question was dropped
+    return history[start:]
+
+@functools.lru_cache(maxsize=512)
+def _system_message(system_prompt_content: str) -> dict:
+    # One shared dict per distinct system prompt instead of a new one every turn. The OpenAI SDK only reads it; don't mutate it.
+    return {"role": "system", "content": system_prompt_content}
+
+@functools.lru_cache(maxsize=512)
+def _user_context_message(user_name: str) -> dict:
+    # Who Kinecho is talking to goes in its own message after the persona prompt, so the persona prefix stays identical for everyone
+    return {"role": "system", "content": USER_CONTEXT_PROMPT.format(user_name=user_name)}
+
+def _history_summary_message(summary: str) -> dict:
+    return {"role": "system", "content": HISTORY_SUMMARY_CONTEXT.format(summary=summary)}
+
+def _build_messages(memory: dict, user_id: str, prompt_text: str, channel_id: str, history: list = None) -> list:
+    """
+    Assembles the OpenAI messages for one prompt: the persona system prompt, the user's recent
+    history in this channel (or the given history instead), then the prompt itself.
+    """
+    # Retrieve the specific user's data
     user_data = memory.get("users", {}).get(user_id, {})
-    user_events = user_data.get("events", [])
     user_name = user_data.get("profile", {}).get("name", "User")
-    print (f"DEBUG: Retrieved user_name from memory: '{user_name}' for user_id: '{user_id}")
+    logger.debug("Retrieved user_name from memory: '%s' for user_id: '%s'", user_name, user_id)
 
     # PERSONA CORE
     system_prompt_content = "You are a helpful AI companion named Kinecho." # Default in case of loading failure
     try:
-        system_prompt_content = load_system_prompt(user_name)
+        system_prompt_content = load_system_prompt()
 #        print("DEBUG: System prompt content prepared.")
     except Exception as e:
-        print(f"ERROR: Failed to prepare system prompt content: {e}")
-        traceback.print_exc()
-        print("WARNING: Proceeding with default system prompt.")
+        logger.exception("Failed to prepare system prompt content: %s", e)
+        logger.warning("Proceeding with default system prompt.")
+    system_messages = [_system_message(system_prompt_content), _user_context_message(user_name)]
+    summary = memory_manager.get_channel_summary(memory, user_id, channel_id)
+    if summary: # Older history that was compacted by summarize_old_history()
+        system_messages.append(_history_summary_message(summary))
+
+    # Conversation history is stored per (user, channel) already in OpenAI's message shape, so this is just a slice.
+    # The current prompt is only recorded after we answer, so it never needs to be filtered out of its own history.
+    if history is None:
+        history = memory_manager.get_channel_memory(memory, user_id, channel_id)
+    if not history: # First turn in this channel (e.g. a one-off DM): nothing to slice or count tokens for
+        return [*system_messages, {"role": "user", "content": prompt_text}]
+    history = _trim_history_to_budget(system_messages, history[-MAX_HISTORY_MESSAGES:])
 
     messages = [
-        {"role": "system",
-         "content": system_prompt_content
-        },
+        *system_messages,
+        *history,
+        {"role": "user", "content": prompt_text} # Finally, the current user prompt
     ]
+    return messages
 
-    # Build the conversation history from user_events for the current channel.
-    # We iterate through events, format them, and add them to 'messages'.
-    # The last 'message_in' event in memory corresponds to the 'prompt_text'
-    # we're currently processing. We *don't* add it to the history list here
-    # because 'prompt_text' will be added explicitly as the last message.
-    # This prevents duplicating the current user message in the context.
-
-    # Find the index of the current 'message_in' event in the user_events list.
-    # This is a robust way to ensure we don't include the current message in the history.
-    current_message_event_index = -1
-    # Iterate backwards to find the most recent matching user message for this channel
-    for i in range(len(user_events) - 1, -1, -1):
-        event = user_events[i]
-        if (event["channel_id"] == channel_id and
-            event["type"] == "message_in" and
-            event["content"] == prompt_text):
-            current_message_event_index = i
-            break
-
-    for i, event in enumerate(user_events):
-        # Skip the current incoming message if found, as it will be appended separately
-        if i == current_message_event_index:
-            continue
-
-        # Only add messages from the current channel
-        if event["channel_id"] == channel_id:
-            if event["type"] == "message_in":
-                messages.append({"role": "user", "content": event["content"]})
-            elif event["type"] == "message_out":
-                messages.append({"role": "assistant", "content": event["content"]})
-
-    # Finally, add the current user prompt to the messages list
-    messages.append({"role": "user", "content": prompt_text})
-
-    print(f"DEBUG: Messages sent to OpenAI API: {messages}")
+def _load_memory_for_request() -> dict:
+    try:
+        return memory_manager.load_memory() # Load the overall memory structure
+#        print("DEBUG: Memory loaded successfully.")
+    except Exception as e:
+        logger.exception("Failed to load memory: %s", e)
+        logger.warning("Proceeding with empty memory for this request.")
+        return {}
 
+def _prefetch_prompt_template():
+    # Warms the template cache ahead of load_system_prompt, which reports any errors itself
     try:
-        selected_model = "gpt-3.5-turbo" # Will be updated to a more powerful model in the future
+        _read_prompt_template()
+    except Exception:
+        pass
 
-        completion = client.chat.completions.create(
+async def get_chat_response(*, user_id: str = "anonymous", prompt_text: str, channel_id: str, interface_type: str = "console",
+                            history: list = None, on_delta=None):
+    """
+    Generates a chat response using OpenAI's API. All arguments are keyword-only.
+    The user's recent history in this channel is replayed before the new prompt, unless history
+    (a list of {"role", "content"} dicts) is given to use instead.
+    The response is streamed: if given, on_delta is awaited with each new chunk of text as it arrives,
+    so interfaces can start showing the reply before it's finished. The full response is always returned.
+    """
+#    print(f"DEBUG: get_chat_response received: user_id={user_id}, prompt='{prompt_text}', channel_id={channel_id}, interface_type={interface_type}")
+
+    # Memory and the prompt template (disk) don't depend on each other,
+    # so fetch them concurrently: the turn pays for the slower of them instead of their sum.
+    memory, _ = await asyncio.gather(
+        asyncio.to_thread(_load_memory_for_request),
+        asyncio.to_thread(_prefetch_prompt_template)
+    )
+
+    messages = _build_messages(memory, user_id, prompt_text, channel_id, history)
+
+    logger.debug("Messages sent to OpenAI API: %s", messages) # Formatted only if DEBUG is enabled
+
+    try:
+        selected_model = CHAT_MODEL
+
+        stream = await client.chat.completions.create(
             model=selected_model,
-            messages=messages
+            messages=messages,
+            stream=True # First tokens arrive in a few hundred ms instead of after the whole reply is decoded
         )
+        response_parts = []
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                response_parts.append(delta)
+                if on_delta is not None:
+                    await on_delta(delta)
 #        print("DEBUG: Successfully received response from OpenAI API.")
-        response_content = completion.choices[0].message.content
-        return response_content
+        return "".join(response_parts)
     except Exception as e:
-        print(f"Error getting chat response from OpenAI: {e}")
-        traceback.print_exc()
+        logger.exception("Error getting chat response from OpenAI: %s", e)
         return f"I'm sorry, I'm having trouble connecting to my brain ('{selected_model}') right now. Please try again later."
 
+_summary_tasks = {} # (user_id, channel_id) -> running summarization task; also keeps a reference so the task isn't garbage collected
+
+def summarize_old_history(memory: dict, user_id: str, channel_id: str):
+    """
+    Once a channel's history grows HISTORY_SUMMARY_SLACK messages past MAX_HISTORY_MESSAGES, starts a background task
+    that folds the oldest messages into the channel's running summary instead of letting them fall off the end.
+    Call this after recording a turn; it returns immediately.
+    """
+    history = memory_manager.get_channel_memory(memory, user_id, channel_id)
+    key = (user_id, channel_id)
+    if len(history) <= MAX_HISTORY_MESSAGES + HISTORY_SUMMARY_SLACK or key in _summary_tasks:
+        return
+    task = asyncio.create_task(_summarize_oldest(memory, user_id, channel_id))
+    _summary_tasks[key] = task
+    task.add_done_callback(lambda _: _summary_tasks.pop(key, None))
+
+async def _summarize_oldest(memory: dict, user_id: str, channel_id: str):
+    history = memory_manager.get_channel_memory(memory, user_id, channel_id)
+    count = len(history) - MAX_HISTORY_MESSAGES
+    if count < len(history) and history[count]["role"] == "assistant":
+        count += 1 # Keep the remaining history starting on a user message
+    oldest = history[:count]
+    previous_summary = memory_manager.get_channel_summary(memory, user_id, channel_id)
+    transcript = "\n".join(f"{message['role']}: {message['content']}" for message in oldest)
+    if previous_summary:
+        transcript = f"Previous summary: {previous_summary}\n\n{transcript}"
+
+    try:
+        completion = await client.chat.completions.create(
+            model=CHAT_MODEL,
+            messages=[
+                {"role": "system", "content": HISTORY_SUMMARY_PROMPT},
+                {"role": "user", "content": transcript}
+            ]
+        )
+        summary = completion.choices[0].message.content
+    except Exception as e:
+        logger.error("Failed to summarize history for user_id: '%s' in channel: '%s': %s", user_id, channel_id, e)
+        return
+    if not summary:
+        return
+
+    # Turns recorded while we waited were appended at the end; only compact if the oldest messages are still the ones we summarized
+    history = memory_manager.get_channel_memory(memory, user_id, channel_id)
+    if len(history) < count or history[0] is not oldest[0]:
+        logger.debug("History for user_id: '%s' in channel: '%s' changed while summarizing; skipping.", user_id, channel_id)
+        return
+    memory_manager.compact_channel_memory(memory, user_id, channel_id, count, summary)
+    memory_manager.request_save(memory)
+
+async def get_chat_response_batch(prompts: list, interface_type: str = "offline") -> list:
+    """
+    Generates responses for many prompts at once through OpenAI's Batch API, which costs half as much
+    as live requests but may take up to 24 hours. Only meant for offline work (seeding memory, evaluations,
+    replying to archived messages); any other interface_type just runs the prompts through get_chat_response.
+
+    Args:
+        prompts (list): (user_id, prompt_text, channel_id) tuples.
+        interface_type (str): "offline" to use the Batch API.
+
+    Returns:
+        list: One response per prompt, in the same order. None for prompts the batch failed to answer.
+    """
+    if interface_type != "offline": # Live chat can't wait on a batch window
+        return await asyncio.gather(*(
+            get_chat_response(user_id=user_id, prompt_text=prompt_text, channel_id=channel_id, interface_type=interface_type)
+            for user_id, prompt_text, channel_id in prompts
+        ))
+
+    memory = await asyncio.to_thread(memory_manager.load_memory) # Off the event loop, like every other turn path
+    batch_lines = []
+    for i, (user_id, prompt_text, channel_id) in enumerate(prompts):
+        batch_lines.append(json.dumps({
+            "custom_id": str(i), # Results come back unordered; this maps them back to their prompt
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {"model": CHAT_MODEL, "messages": _build_messages(memory, user_id, prompt_text, channel_id)}
+        }))
+
+    responses = [None] * len(prompts)
+    try:
+        batch_file = await client.files.create(
+            file=("kinecho_batch.jsonl", "\n".join(batch_lines).encode("utf-8")),
+            purpose="batch"
+        )
+        batch = await client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h"
+        )
+        logger.info("Batch %s submitted with %d prompts.", batch.id, len(prompts))
+        while batch.status not in ("completed", "failed", "expired", "cancelled"):
+            await asyncio.sleep(BATCH_POLL_INTERVAL)
+            batch = await client.batches.retrieve(batch.id)
+
+        if batch.status != "completed" or not batch.output_file_id:
+            logger.error("Batch %s finished with status '%s'.", batch.id, batch.status)
+            return responses
+
+        output = await client.files.content(batch.output_file_id)
+        for line in output.text.splitlines():
+            if not line.strip():
+                continue
+            result = json.loads(line)
+            response = result.get("response") or {}
+            if result.get("error") or response.get("status_code") != 200:
+                logger.error("Batch prompt %s failed: %s", result.get("custom_id"), result.get("error") or response.get("body"))
+                continue
+            responses[int(result["custom_id"])] = response["body"]["choices"][0]["message"]["content"]
+    except Exception as e:
+        logger.exception("Error running chat batch through OpenAI: %s", e)
+    return responses
+
+async def get_grouped_chat_responses(prompts: list, channel_id: str) -> list:
+    """
+    Answers several users' messages from the same channel with a single OpenAI request, for bursts of
+    messages that would otherwise each spend a request against the rate limit.
+
+    Args:
+        prompts (list): (user_id, prompt_text) tuples, at most 26 (they're labeled A-Z).
+        channel_id (str): The channel the messages were sent in.
+
+    Returns:
+        list: One response per prompt, in the same order. None where the model's reply couldn't be
+        matched back to a prompt; callers should fall back to get_chat_response for those.
+    """
+    memory = await asyncio.to_thread(memory_manager.load_memory) # Off the event loop, like every other turn path
+    labels = [chr(ord("A") + i) for i in range(len(prompts))]
+    names = [memory.get("users", {}).get(user_id, {}).get("profile", {}).get("name", "User") for user_id, _ in prompts]
+
+    labeled_messages = "\n\n".join(
+        _grouped_prompt_block(memory, label, name, user_id, prompt_text, channel_id)
+        for label, name, (user_id, prompt_text) in zip(labels, names, prompts)
+    )
+    messages = [
+        _system_message(load_system_prompt()),
+        _user_context_message(", ".join(dict.fromkeys(names))),
+        {"role": "user", "content": (
+            "Several people messaged you at once. Reply to each message separately, as if it were the only one. "
+            "Each message comes with that person's earlier conversation with you, if any; use it the way you would in a one-on-one chat. "
+            "Respond with a JSON object whose keys are the message labels and whose values are your replies.\n\n"
+            + labeled_messages
+        )}
+    ]
+    logger.debug("Grouped %d prompts from channel %s into one request.", len(prompts), channel_id)
+
+    try:
+        completion = await client.chat.completions.create(
+            model=CHAT_MODEL,
+            messages=messages,
+            response_format={"type": "json_object"}
+        )
+        replies = json.loads(completion.choices[0].message.content)
+    except Exception as e:
+        logger.exception("Error getting grouped chat response from OpenAI: %s", e)
+        return [None] * len(prompts)
+    return [replies.get(label) if isinstance(replies.get(label), str) else None for label in labels]
+
+def _grouped_prompt_block(memory: dict, label: str, name: str, user_id: str, prompt_text: str, channel_id: str) -> str:
+    """
+    One labeled message for get_grouped_chat_responses, preceded by the user's summary and recent history in the channel,
+    so a grouped reply has the same conversation context as a one-on-one one.
+    """
+    lines = [f"{label} ({name}):"]
+    summary = memory_manager.get_channel_summary(memory, user_id, channel_id)
+    if summary:
+        lines.append(f"Summary of your earlier conversation: {summary}")
+    history = memory_manager.get_channel_memory(memory, user_id, channel_id)[-GROUPED_HISTORY_MESSAGES:]
+    if history and history[0]["role"] == "assistant":
+        history = history[1:] # Don't open the history with a reply whose question was dropped
+    lines.extend(f"{'You' if message['role'] == 'assistant' else name}: {message['content']}" for message in history)
+    lines.append(f"New message: {prompt_text}")
+    return "\n".join(lines)
+
+def _get_engine():
+    global engine
+    if engine is None:
+        import pyttsx3
+        engine = pyttsx3.init() # Initialize PyTTS engine
+    return engine
+
+def _get_recognizer():
+    global recognizer
+    if recognizer is None:
+        import speech_recognition as sr
+        recognizer = sr.Recognizer()
+    return recognizer
+
+def _get_microphone():
+    global microphone
+    if microphone is None:
+        import speech_recognition as sr
+        microphone = sr.Microphone()
+    return microphone
+
+def _get_mic_source():
+    """
+    Returns the open microphone stream, opening it on first use.
+    The stream stays open between calls so each utterance skips the PortAudio open/close, and the ~1s noise
+    calibration only runs again once MIC_RECALIBRATE_INTERVAL has passed.
+    """
+    global mic_source, mic_calibrated_at
+    if mic_source is None:
+        mic_source = _get_microphone().__enter__()
+    now = time.monotonic()
+    if mic_calibrated_at is None or now - mic_calibrated_at > MIC_RECALIBRATE_INTERVAL:
+        _get_recognizer().adjust_for_ambient_noise(mic_source)
+        mic_calibrated_at = now
+    return mic_source
+
 def listen_for_command():
-    r = sr.Recognizer()
-    with sr.Microphone() as source:
-        print("Kinecho is listening...")
-        r.adjust_for_ambient_noise(source)
-        try:
-            audio = r.listen(source, timeout=10)
-            print("Audio captured.")
-            return audio
-        except sr.WaitTimeoutError:
-            print("No speech detected.") # In case I become Silent Sally
-            return ""
-        except sr.RequestError as e:
-            print(f"Could not request results; {e}") # In case the API fails
-            return ""
-        except sr.UnknownValueError:
-            print("Could not understand audio") # In case I'm too garbled
-            return ""
-        except Exception as e:
-            print(f"Error during listening: {e}") # For literally everything else
-            return ""
+    import speech_recognition as sr
+    r = _get_recognizer()
+    source = _get_mic_source()
+    print("Kinecho is listening...")
+    try:
+        audio = r.listen(source, timeout=10)
+        print("Audio captured.")
+        return audio
+    except sr.WaitTimeoutError:
+        print("No speech detected.") # In case I become Silent Sally
+        return ""
+    except sr.RequestError as e:
+        print(f"Could not request results; {e}") # In case the API fails
+        return ""
+    except sr.UnknownValueError:
+        print("Could not understand audio") # In case I'm too garbled
+        return ""
+    except Exception as e:
+        print(f"Error during listening: {e}") # For literally everything else
+        return ""
 
 def transcribe_audio(audio):
+    import speech_recognition as sr
     if audio:
-        r = sr.Recognizer()
+        r = _get_recognizer()
         try:
             text = r.recognize_google(audio) # Using Google Speech Recognition
             print(f"You said: {text}")
@@ -175,32 +507,145 @@ def transcribe_audio(audio):
             return None
     return None
 
-def speak_response(response_text):
+# Voice input runs on one dedicated thread: the open microphone stream is only ever touched from the same thread
+_voice_input_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="kinecho-voice-input")
+
+async def listen_for_command_async():
+    """
+    Async version of listen_for_command: listening (up to its 10s timeout) happens off the event loop.
+    """
+    return await asyncio.get_running_loop().run_in_executor(_voice_input_executor, listen_for_command)
+
+async def transcribe_audio_async(audio):
+    """
+    Async version of transcribe_audio: the Google Speech Recognition request happens off the event loop.
+    """
+    return await asyncio.get_running_loop().run_in_executor(_voice_input_executor, transcribe_audio, audio)
+
+_tts_queue = queue.Queue() # (text, loop, future or None) waiting to be spoken by the TTS thread, in order
+_tts_thread = None # Started on first use, see _queue_speech()
+
+def _resolve_speech_future(future):
+    if not future.done(): # The awaiting coroutine may have been cancelled
+        future.set_result(None)
+
+def _tts_worker():
+    # The only thread that ever touches the pyttsx3 engine: engines aren't thread-safe, and some drivers are bound to the thread that created them
+    while True:
+        text, loop, done = _tts_queue.get()
+        try:
+            if text:
+                tts_engine = _get_engine()
+                tts_engine.say(text)
+                tts_engine.runAndWait() # Blocks this thread (only) until playback finishes
+        except Exception as e:
+            logger.exception("Error during text-to-speech playback: %s", e)
+        finally:
+            if done is not None:
+                loop.call_soon_threadsafe(_resolve_speech_future, done) # Passed as an argument: a closure over done would see the next queue item
+
+def _queue_speech(text: str, wait: bool = False):
+    """
+    Hands text to the TTS thread and returns immediately.
+    With wait=True, returns a future that completes once the text (and everything queued before it) has been spoken.
+    """
+    global _tts_thread
+    if _tts_thread is None:
+        _tts_thread = threading.Thread(target=_tts_worker, name="kinecho-tts", daemon=True)
+        _tts_thread.start()
+    loop = asyncio.get_running_loop()
+    done = loop.create_future() if wait else None
+    _tts_queue.put((text, loop, done))
+    return done
+
+async def speak_response(response_text):
+    """
+    Speaks response_text aloud and waits until it has been spoken. Playback runs on the dedicated TTS thread,
+    so the event loop (and Discord) keeps running meanwhile.
+    """
     if response_text:
-        engine.say(response_text)
-        engine.runAndWait()
+        await _queue_speech(response_text, wait=True)
 
-def load_settings():
-    config = configparser.ConfigParser()
-    if os.path.exists(SETTINGS_FILE):
-        config.read(SETTINGS_FILE)
-    else:
-        # Create default sections if the file doesn't exist
-        config['input'] = {'method': 'text'}
-        config['output'] = {'method': 'text'}
+_settings_cache = None # Last parsed settings, reused until settings.ini changes on disk
+_settings_mtime = None
 
-    settings = {
-        'input': {'method': config.get('input', 'method', fallback='text')},
-        'output': {'method': config.get('output', 'method', fallback='text')},
-    }
-    return settings
+SENTENCE_END_RE = re.compile(r"(?<=[.!?])\s+") # Where a streamed response can be cut into speakable sentences
+
+class StreamingSpeaker:
+    """
+    Speaks a streamed response one sentence at a time, so speech starts as soon as the first sentence
+    is complete instead of after the whole response has been generated.
+    Sentences are queued to the TTS thread, which speaks them in order; pass on_delta as a chatbot on_delta callback.
+    """
+
+    def __init__(self):
+        self._buffer = "" # Text received but not yet queued (an unfinished sentence)
+        self._streamed = False
+
+    async def on_delta(self, delta: str):
+        self._streamed = True
+        self._buffer += delta
+        *sentences, self._buffer = SENTENCE_END_RE.split(self._buffer)
+        for sentence in sentences:
+            _queue_speech(sentence.strip())
+
+    async def finish(self, response_text: str):
+        """
+        Speaks whatever is left of the response and waits until playback is done.
+        If nothing was streamed (e.g. an error reply), the whole response is spoken.
+        """
+        remainder = (self._buffer if self._streamed else response_text).strip()
+        self._buffer = ""
+        await _queue_speech(remainder, wait=True) # Queued last, so it's done once everything before it is spoken
+
+def _settings_file_mtime():
+    try:
+        return os.stat(SETTINGS_FILE).st_mtime
+    except FileNotFoundError:
+        return None
+
+def load_settings():
+    """
+    Returns the current settings. settings.ini is only parsed again if its mtime changed since the last call.
+    Each caller gets its own copy, so unsaved changes never leak into the cache.
+    """
+    global _settings_cache, _settings_mtime
+    mtime = _settings_file_mtime()
+
+    if _settings_cache is None or mtime != _settings_mtime:
+        config = configparser.ConfigParser()
+        if mtime is not None:
+            config.read(SETTINGS_FILE)
+        else:
+            # Create default sections if the file doesn't exist
+            config['input'] = {'method': 'text'}
+            config['output'] = {'method': 'text'}
+
+        _settings_cache = {
+            'input': {'method': config.get('input', 'method', fallback='text')},
+            'output': {'method': config.get('output', 'method', fallback='text')},
+        }
+        _settings_mtime = mtime
+    return {section: dict(values) for section, values in _settings_cache.items()}
 
 def save_settings(settings):
+    """
+    Writes settings to settings.ini and updates the cache, so the next load_settings() doesn't re-parse our own write.
+    Does nothing if settings match what's already on disk.
+    """
+    global _settings_cache, _settings_mtime
+    new_settings = {section: {'method': settings[section]['method']} for section in ('input', 'output')}
+    if new_settings == _settings_cache and _settings_mtime is not None and _settings_mtime == _settings_file_mtime():
+        return # Unchanged (e.g. the same method was picked again), and nobody edited the file since we last read or wrote it
     config = configparser.ConfigParser()
     config['input'] = {'method': settings['input']['method']}
     config['output'] = {'method': settings['output']['method']}
-    with open(SETTINGS_FILE, 'w') as configfile:
+    temp_file = SETTINGS_FILE.with_suffix(".ini.tmp")
+    with open(temp_file, 'w') as configfile:
         config.write(configfile)
+    os.replace(temp_file, SETTINGS_FILE) # Atomic, so a crash mid-write can't leave a truncated settings.ini
+    _settings_cache = new_settings
+    _settings_mtime = os.stat(SETTINGS_FILE).st_mtime
 
 def switch_method(method_type, valid_options, settings):
     """
@@ -1,5 +1,6 @@
 from abc import ABC, abstractmethod
-from typing import Callable, Any, Dict, List
+from typing import Awaitable, Callable, Any, Dict, List
+import memory_manager
 
 class KinechoInterface(ABC):
     """
@@ -7,16 +8,30 @@ class KinechoInterface(ABC):
     Defines the common methods that all interfaces must implement.
     """
 
-    def __init__(self, chatbot_processor_func: Callable[[str, Any, Any], str]):
+    def __init__(self, chatbot_processor_func: Callable[[str, Any, Any], Awaitable[str]]):
         """
         Initializes the interface with a function to process chatbot messages.
         Args:
-            chatbot_processor_func: The function (e.g., chatbot.get_chat_response)
-                                    that handles AI responses.
+            chatbot_processor_func: The async function (e.g., chatbot.get_chat_response)
+                                    that handles AI responses. It must be awaited.
         """
         self.chatbot_processor = chatbot_processor_func
         self.is_running = False
 
+    def save_memory_in_background(self, memory: dict):
+        """
+        Hands memory to memory_manager's single writer task without waiting for the write,
+        so the reply isn't held up by disk I/O. Call flush_pending_saves() when stopping so nothing is lost.
+        """
+        memory_manager.request_save(memory)
+
+    async def flush_pending_saves(self) -> bool:
+        """
+        Waits for every memory save requested so far (by any interface) to be written.
+        Returns False if some changes could not be saved.
+        """
+        return await memory_manager.flush_saves()
+
     @abstractmethod
     async def initialize_interface(self): # Change from "Start" to "initialize_interface"
         """
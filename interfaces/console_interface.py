@@ -1,11 +1,18 @@
 import asyncio
-from typing import Callable, List, Dict, Any
+import logging
+import sys
+import time
+from typing import Awaitable, Callable, List, Dict, Any
 from interfaces.base_interface import KinechoInterface
 import memory_manager
 import chatbot
 
+logger = logging.getLogger("kinecho.console")
+
+STREAM_FLUSH_INTERVAL = 0.05 # Seconds between stdout flushes while a response streams in; fast enough to look live, without a write per chunk
+
 class ConsoleInterface(KinechoInterface):
-    def __init__(self, *, chatbot_processor_func: Callable[[str, List[Dict[str, str]], str], str]):
+    def __init__(self, *, chatbot_processor_func: Callable[[str, List[Dict[str, str]], str], Awaitable[str]]):
         super().__init__(chatbot_processor_func=chatbot_processor_func)
         self._quit_event = asyncio.Event() # Event to signal when the console interface should quit
         print("Console Interface: Initialized.")
@@ -41,7 +48,7 @@ class ConsoleInterface(KinechoInterface):
 
         if not self.is_running:
             # Should not happen if commander is correctly managing tasks
-            print(f"ERROR: Message ignored: Console Interface is not flagged as running by Commander. ({user_message})")
+            logger.error("Message ignored: Console Interface is not flagged as running by Commander. (%s)", user_message)
             return
 
         if user_message.lower() == 'quit':
@@ -57,31 +64,56 @@ class ConsoleInterface(KinechoInterface):
         console_channel_id = "kinecho_console_chat" # Still use this for channel context in events
 
         # Load memory and ensure the console user exists in memory
-        memory = memory_manager.load_memory()
-        memory_manager.create_or_get_user(memory, console_user_id, console_user_name, "console")
+        memory = await asyncio.to_thread(memory_manager.load_memory) # Normally just the in-process cache, but re-parsing an edited file shouldn't block the loop
 
         # Add user's message as an event BEFORE calling the chatbot
-        memory_manager.add_user_event(memory, console_user_id, "message_in", console_channel_id, user_message, "console")
-        memory_manager.save_memory(memory) # Save immediately after user message event
+        memory_manager.record_user_turn(memory, user_id=console_user_id, user_name=console_user_name, channel_id=console_channel_id,
+                                        interface_type="console", content=user_message)
+        # Not saved yet: the single save at the end of the turn persists this (a failed turn leaves memory dirty for the next save)
 #        print("DEBUG: Console user message event added and memory saved.")
 
         # --- Get response from Chatbot Processor ---
 
 #        print(f"DEBUG: Calling chatbot_processor with query: '{user_message}'")
-        response_content = self.chatbot_processor(
+        # With TTS output, speech starts with the first finished sentence rather than after the full reply
+        speaker = chatbot.StreamingSpeaker() if chatbot.load_settings()['output']['method'] == 'tts' else None
+        streamed_text = "" # What has already been printed while the response streamed in
+        last_flush = 0.0
+        async def print_delta(delta: str):
+            nonlocal streamed_text, last_flush
+            if not streamed_text:
+                print("Kinecho: ", end="")
+            print(delta, end="")
+            now = time.monotonic()
+            if now - last_flush >= STREAM_FLUSH_INTERVAL:
+                sys.stdout.flush()
+                last_flush = now
+            streamed_text += delta
+            if speaker is not None:
+                await speaker.on_delta(delta)
+
+        response_content = await self.chatbot_processor(
             console_user_id,    # This variable should be available from earlier in the method
             user_message,
             console_channel_id, # This variable should be available from earlier in the method
-            "console"           # Explicitly state the interface type
+            "console",          # Explicitly state the interface type
+            on_delta=print_delta # Print the reply as it streams in
         )
 
         # --- Send Response and Update Memory ---
-        await self.send_message(console_channel_id, response_content)
+        if streamed_text:
+            print(flush=True) # End the streamed line, showing whatever the last throttled flush held back
+        if response_content != streamed_text: # The request failed before any text streamed in, or the stream was cut short by an error
+            await self.send_message(console_channel_id, response_content)
+        if speaker is not None:
+            await speaker.finish(response_content)
 #        print("DEBUG: Console Interface: Sent response.")
 
-        # Add bot's response as an event
-        memory_manager.add_user_event(memory, console_user_id, "message_out", console_channel_id, response_content, "console")
-        memory_manager.save_memory(memory) # Save after bot response event
+        # Add bot's response as an event, and record both sides of the exchange in the channel history the chatbot replays next turn
+        memory_manager.record_bot_turn(memory, user_id=console_user_id, channel_id=console_channel_id, interface_type="console",
+                                       query=user_message, response=response_content)
+        self.save_memory_in_background(memory) # One save per turn, covering both events and the channel history; written while the next message is handled
+        chatbot.summarize_old_history(memory, console_user_id, console_channel_id) # Compacts old turns in the background once the history runs long
 #        print("DEBUG: Console bot response event added and memory saved.")
 
 
@@ -91,5 +123,6 @@ class ConsoleInterface(KinechoInterface):
         Signals the initialize_interface task to finish.
         """
         self.is_running = False
+        await self.flush_pending_saves() # Make sure the last turn reached the disk
         self._quit_event.set() # Set the event to release initialize_interface.wait()
         print(f"Console Interface: {self.__class__.__name__} closed successfully.")
\ No newline at end of file
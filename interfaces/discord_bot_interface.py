@@ -1,16 +1,31 @@
+import asyncio
+import collections
 import discord
+import logging
 import os
-import re
+import time
 from dotenv import load_dotenv
-from typing import Any, Callable, List, Dict
+from typing import Any, Awaitable, Callable, List, Dict
 from interfaces.base_interface import KinechoInterface
 import memory_manager
 import chatbot
 
 load_dotenv()
 TOKEN = os.getenv("DISCORD_BOT_TOKEN")
+logger = logging.getLogger("kinecho.discord")
 
-LAST_RESPONSE_MESSAGE_ID = {}
+LAST_RESPONSE_CACHE_SIZE = 1024 # Channels whose last response message ID is remembered; least recently used ones are forgotten first
+CHANNEL_CACHE_SIZE = 1024 # Channel objects kept by send_message; least recently used ones are resolved again on their next send
+STREAM_EDIT_INTERVAL = 1.1 # Seconds between edits of a reply that is still streaming in (Discord allows about 5 edits per 5s per channel)
+MESSAGE_MAX_LENGTH = 2000 # Discord rejects messages (and edits) longer than this
+BURST_LOOKBACK = 5.0 # Seconds of recent activity considered when deciding whether a channel is bursty
+BURST_THRESHOLD = 3 # Messages within BURST_LOOKBACK, from at least two different people, that make a channel bursty
+BURST_TRACKED_CHANNELS = 1024 # Guild channels whose recent activity is tracked; least recently active ones are forgotten first
+GROUP_DEBOUNCE = 0.2 # Seconds a bursty channel waits for more messages to answer in the same OpenAI request
+GROUP_MAX_SIZE = 10 # Most messages answered by one grouped request
+
+SENDABLE_CHANNEL_TYPES = (discord.TextChannel, discord.DMChannel, discord.Thread) # Built once, not on every send_message call
+CHANNEL_ID_TYPES = (str, int)
 
 intents = discord.Intents.default()
 intents.message_content = True
@@ -20,12 +35,72 @@ intents.presences = True
 intents.guild_messages = True
 intents.dm_messages = True
 
+class _StreamingReply:
+    """
+    Shows a chatbot reply in Discord while it's still being generated.
+    The first chunk is sent as a new message; later chunks edit that message at most every STREAM_EDIT_INTERVAL seconds,
+    until the reply grows past what one Discord message can hold.
+    """
+
+    def __init__(self, interface: "DiscordInterface", channel: Any, prefix: str = ""):
+        self.interface = interface
+        self.channel = channel
+        self.prefix = prefix # e.g. the author mention for guild replies
+        self.text = ""
+        self.message = None # The discord.Message being edited, once sent
+        self._shown = None # Content currently visible in Discord
+        self._last_edit = 0.0
+        self._send_failed = False
+        self._too_long = False # Set once the reply outgrows MESSAGE_MAX_LENGTH; further edits would only be rejected
+
+    async def on_delta(self, delta: str):
+        self.text += delta
+        if self._send_failed or self._too_long:
+            return
+        if self.message is None:
+            self._shown = self.prefix + self.text
+            self.message = await self.interface.send_message(self.channel, self._shown)
+            self._send_failed = self.message is None # Don't retry on every chunk; finish() sends the full reply
+            self._last_edit = time.monotonic()
+        elif time.monotonic() - self._last_edit >= STREAM_EDIT_INTERVAL:
+            await self._edit(self.prefix + self.text)
+
+    async def finish(self, final_text: str):
+        """
+        Makes sure the complete reply is shown, whether or not anything was streamed (e.g. error replies).
+        """
+        content = self.prefix + final_text
+        if self.message is None:
+            await self.interface.send_message(self.channel, content)
+        elif content != self._shown and not self._too_long:
+            await self._edit(content)
+
+    async def _edit(self, content: str):
+        if len(content) > MESSAGE_MAX_LENGTH:
+            self._too_long = True # Logged once here instead of a rejected edit every STREAM_EDIT_INTERVAL
+            logger.warning("Streamed response in channel %s is longer than %d characters; no longer editing it.",
+                           getattr(self.channel, 'id', self.channel), MESSAGE_MAX_LENGTH)
+            return
+        try:
+            await self.message.edit(content=content)
+            self._shown = content
+        except Exception as e:
+            logger.error("Error editing streamed response: %s", e)
+        self._last_edit = time.monotonic()
+
 class DiscordInterface(KinechoInterface, discord.Client):
-    def __init__(self, *, chatbot_processor_func: Callable[[str, List[Dict[str, str]], str], str], intents: discord.Intents):
+    def __init__(self, *, chatbot_processor_func: Callable[[str, List[Dict[str, str]], str], Awaitable[str]], intents: discord.Intents):
         # IMPORTANT: The chatbot_processor_func signature will change soon,
         # but for now, we're keeping it compatible until kinecho_main.py is updated.
         super().__init__(chatbot_processor_func=chatbot_processor_func)
         discord.Client.__init__(self, intents=intents)
+        # In-process bookkeeping is keyed by Discord's int channel IDs; str IDs are only used where they reach memory_manager (JSON keys)
+        self._recent_message_times: collections.OrderedDict = collections.OrderedDict() # channel ID -> (timestamp, author ID) of recent messages to process
+        self._pending_groups: Dict[str, list] = {} # channel_id -> [(user_id, query, future)] waiting to be answered together
+        self._flush_tasks = set() # Running _flush_group tasks; holding a reference keeps them from being garbage collected
+        self._last_response_ids: collections.OrderedDict = collections.OrderedDict() # channel_id -> ID of our last message there
+        self._channel_cache: collections.OrderedDict = collections.OrderedDict() # channel ID -> channel object resolved by send_message, so IDs aren't looked up (or fetched) again
+        self._mention_strs = () # The two forms of our own mention (<@id> and <@!id>), set in on_ready once self.user is known
         print("Discord Interface: Initialized.")
 
     async def initialize_interface(self, bot_token: str):
@@ -53,29 +128,49 @@ class DiscordInterface(KinechoInterface, discord.Client):
         Sends a message through the Discord interface to a specific channel.
         target_channel can be a channel ID (str) or a discord.abc.Messageable object.
         Reverted to original flexibility for now to avoid breaking Commander before its update.
+        Returns the sent discord.Message, or None if it couldn't be sent.
         """
         try:
+            if hasattr(target_channel, "send"): # Usual case: already a discord.abc.Messageable object (e.g., discord.TextChannel)
+                channel = target_channel
             # If a channel ID string is passed, try to fetch the channel object
-            if isinstance(target_channel, (str, int)):
+            elif isinstance(target_channel, CHANNEL_ID_TYPES):
                 channel_id_int = int(target_channel)
-                channel = self.get_channel(channel_id_int)
-                if not channel: # Fallback to fetch if not in cache
-                    channel = await self.fetch_channel(channel_id_int)
-            else: # Assume it's already a discord.abc.Messageable object (e.g., discord.TextChannel)
-                channel = target_channel
+                channel = self._channel_cache.get(channel_id_int)
+                if channel is None:
+                    channel = self.get_channel(channel_id_int)
+                    if not channel: # Fallback to fetch if not in cache
+                        channel = await self.fetch_channel(channel_id_int)
+                    self._channel_cache[channel_id_int] = channel
+                    if len(self._channel_cache) > CHANNEL_CACHE_SIZE:
+                        self._channel_cache.popitem(last=False)
+                else:
+                    self._channel_cache.move_to_end(channel_id_int)
+            else:
+                channel = None
 
-            if channel and isinstance(channel, (discord.TextChannel, discord.DMChannel, discord.Thread)):
+            if channel and isinstance(channel, SENDABLE_CHANNEL_TYPES):
                 message = await channel.send(message_content)
-                LAST_RESPONSE_MESSAGE_ID[str(channel.id)] = message.id
-                print(f"Discord Interface: Sent response to {channel.name if not isinstance(channel, discord.DMChannel) else 'DM'}")
+                self._remember_last_response(channel.id, message.id)
+                logger.debug("Sent response to %s", channel.name if not isinstance(channel, discord.DMChannel) else 'DM') # Runs for every streamed reply, so only at DEBUG
+                return message
             else:
-                print(f"Discord Interface Error: Channel with ID/object {target_channel} not found or not a text/DM/thread channel. Content: '{message_content}'")
+                logger.error("Channel with ID/object %s not found or not a text/DM/thread channel. Content: '%s'", target_channel, message_content)
         except discord.Forbidden:
-            print(f"Discord Interface Error: Bot lacks permissions to send message in {target_channel.name if hasattr(target_channel, 'name') else 'DM'}/{target_channel.id}.")
+            logger.error("Bot lacks permissions to send message in %s/%s.", getattr(target_channel, 'name', 'DM'), getattr(target_channel, 'id', target_channel))
         except Exception as e:
-            print(f"Discord Interface Error sending message to {target_channel.id if hasattr(target_channel, 'id') else 'unknown'}: {e}")
+            logger.error("Error sending message to %s: %s", getattr(target_channel, 'id', 'unknown'), e)
+
+    def _remember_last_response(self, channel_id: int, message_id: int):
+        self._last_response_ids[channel_id] = message_id
+        self._last_response_ids.move_to_end(channel_id)
+        if len(self._last_response_ids) > LAST_RESPONSE_CACHE_SIZE:
+            self._last_response_ids.popitem(last=False) # Bounded, so it doesn't grow with every channel the bot has ever answered in
 
     async def on_message(self, message: discord.Message):
+        # Fast path: most messages in a guild aren't for us, so drop them before setting up a receive_message call
+        if message.author == self.user or (message.guild is not None and not self.user.mentioned_in(message)):
+            return
         await self.receive_message(message)
 
     # This method explicitly implements the abstract method 'receive_message' from KinechoInterface.
@@ -85,18 +180,23 @@ class DiscordInterface(KinechoInterface, discord.Client):
         Processes an incoming message from Discord.
         This method is the KinechoInterface abstraction for incoming messages.
         """
+        # Looked up once here rather than through attribute chains at every use below
+        bot_user = self.user
+        author = message.author
+        guild = message.guild
+
         # Ignore messages from the bot itself
-        if message.author == self.user:
-#           print(f"DEBUG: Message ignored: From bot itself ({self.user.name}).")
+        if author == bot_user:
+#           print(f"DEBUG: Message ignored: From bot itself ({bot_user.name}).")
             return
 
         # Ensure the bot is intended to be running (controlled by Commander)
         if not self.is_running:
-            print(f"ERROR: Message ignored: Discord Interface is not flagged as running by Commander. How did you manage this?")
+            logger.error("Message ignored: Discord Interface is not flagged as running by Commander. How did you manage this?")
             return
 
         # Determine if the message is a direct mention or a DM
-        is_direct_mention = self.user.mentioned_in(message)
+        is_direct_mention = bot_user.mentioned_in(message)
         is_dm = isinstance(message.channel, discord.DMChannel)
 #        print(f"DEBUG: Is direct mention: {is_direct_mention}")
 #        print(f"DEBUG: Is DM: {is_dm}")
@@ -111,13 +211,13 @@ class DiscordInterface(KinechoInterface, discord.Client):
 #            print(f"DEBUG: Message qualifies for processing (DM or Direct Mention).")
 
             # Extract user_id and user_name for the new memory system
-            user_id = str(message.author.id) # Use Discord user ID as our unique user_id
-            user_name = message.author.display_name if message.author.display_name else message.author.name
+            author_id = author.id
+            user_id = str(author_id) # Use Discord user ID as our unique user_id
+            user_name = author.display_name or author.name # display_name is a computed property, so only read it once
 
-            # Load memory and ensure user exists
-            memory = memory_manager.load_memory()
-            memory_manager.create_or_get_user(memory, user_id, user_name, "discord", discord_id=user_id)
-            print(f"DEBUG: Message from {user_name} ({user_id}) in channel {channel_id}. Content: '{message.content}'")
+            # Load memory (the user is created, if needed, when their message is recorded below)
+            memory = await asyncio.to_thread(memory_manager.load_memory) # Normally just the in-process cache, but re-parsing an edited file shouldn't block the loop
+            logger.debug("Message from %s (%s) in channel %s. Content: '%s'", user_name, user_id, channel_id, message.content)
 
 
             # Store the original message content *before* mention removal for the user event.
@@ -125,57 +225,129 @@ class DiscordInterface(KinechoInterface, discord.Client):
 
             # Remove bot mention from query for processing if it's a guild message and a direct mention
             query = message.content # query will be the content passed to the chatbot.
-            if is_direct_mention and message.guild: # Only remove mention if in a guild
-                query = re.sub(r'<@!?%s>' % self.user.id, '', query).strip()
+            if is_direct_mention and guild: # Only remove mention if in a guild
+                for mention in self._mention_strs: # Plain replaces instead of a regex substitution on every message
+                    query = query.replace(mention, '')
+                query = query.strip()
 #                print(f"DEBUG: Query after mention removal: '{query}'")
 
             # If the query is empty after mention removal (e.g., just a mention like "@Kinecho")
             if not query:
                 # print("DEBUG: Query is empty after mention removal. Sending a default prompt.")
                 if is_direct_mention: # Only respond to empty mention if it was a direct one
-                    await self.send_message(channel, f"Hey <@{message.author.id}>, what's up?")
+                    await self.send_message(channel, f"Hey <@{author_id}>, what's up?")
                 return
 
             # Add user's message as an event BEFORE calling the chatbot, using the *original* content
-            memory_manager.add_user_event(memory, user_id, "message_in", channel_id, original_message_content, "discord")
-            memory_manager.save_memory(memory) # Save immediately after user message event
+            memory_manager.record_user_turn(memory, user_id=user_id, user_name=user_name, channel_id=channel_id, interface_type="discord",
+                                            content=original_message_content, discord_id=user_id)
+            # Not saved yet: the single save at the end of the turn persists this (a failed turn leaves memory dirty for the next save)
 #            print("DEBUG: User message event added and memory saved.")
 
+            # Prepend a mention to the original message author (only if it was a guild mention)
+            mention_prefix = f"<@{author_id}> " if is_direct_mention and guild else ""
+            streaming_reply = _StreamingReply(self, channel, prefix=mention_prefix)
+
             # --- Get response from Chatbot Processor ---
-            print(f"DEBUG: Calling chatbot_processor with query: '{query}' for user {user_id} in channel {channel_id}")
+            logger.debug("Calling chatbot_processor with query: '%s' for user %s in channel %s", query, user_id, channel_id)
             # Update this line to pass user_id, query, channel_id, and interface_type
-            response_content = self.chatbot_processor(
-                user_id,         # User ID from Discord
-                query,    # Cleaned user message
-                channel_id,      # Channel ID from Discord
-                "discord"        # Explicitly state the interface type
-            )
+            if guild is not None and self._is_bursty(channel.id, author_id):
+                # Busy guild channel: wait briefly for other people's messages so they can share one OpenAI request
+                response_content = await self._get_grouped_response(user_id, query, channel_id)
+            else:
+                response_content = await self.chatbot_processor(
+                    user_id,         # User ID from Discord
+                    query,    # Cleaned user message
+                    channel_id,      # Channel ID from Discord
+                    "discord",       # Explicitly state the interface type
+                    on_delta=streaming_reply.on_delta # Show the reply in Discord as it streams in
+                )
 #            print(f"DEBUG: Raw response from chatbot_processor (chatbot.py): '{response_content}'")
 
-            try: # Prepend a mention to the original message author (only if it was a guild mention)
-                response_to_send = response_content
-                if is_direct_mention and message.guild:
-                    response_to_send = f"<@{message.author.id}> {response_content}"
-                print(f"DEBUG: Final response to send: '{response_to_send}'")
+            try:
+                response_to_send = mention_prefix + response_content
+                logger.debug("Final response to send: '%s'", response_to_send)
 
                 # --- Send Response and Update Memory ---
-                # Pass the channel object directly to send_message
-                await self.send_message(channel, response_to_send)
+                # Most of the reply was already shown while streaming; this sends/edits in whatever is left
+                await streaming_reply.finish(response_content)
 
-                # Now, add the bot's response as an event using the *new* memory system
-                # Use 'message_out' type for outgoing messages from the assistant
-                memory_manager.add_user_event(memory, user_id, "message_out", channel_id, response_to_send, "discord") # Store the full response sent
-                memory_manager.save_memory(memory) # Save after bot response event
+                # Now, add the bot's response as a 'message_out' event (the full response sent, mention included),
+                # and record the cleaned query and raw response in the channel history the chatbot replays next turn
+                memory_manager.record_bot_turn(memory, user_id=user_id, channel_id=channel_id, interface_type="discord", query=query,
+                                               response=response_content, sent_content=response_to_send)
+                self.save_memory_in_background(memory) # One save per turn, covering both events and the channel history; written while the next message is handled
+                chatbot.summarize_old_history(memory, user_id, channel_id) # Compacts old turns in the background once the history runs long
         #        print("DEBUG: Bot response event added and memory saved.")
        
             except Exception as e:
-                print(f"ERROR: An unexpected error occured while preparing/sending Discord response or saving memory: {e}")
+                logger.exception("An unexpected error occured while preparing/sending Discord response or saving memory: %s", e)
                 return   
 
 #       else:
             # If bot not mentioned and not a DM, just ignore.
 #            print(f"DEBUG: Message ignored (not DM or direct mention). Content: '{message.content}'")
 
+    def _is_bursty(self, channel_id: int, author_id: int) -> bool:
+        """
+        Records a message for channel_id and reports whether the channel is busy enough to group requests.
+        Quiet channels, and one person sending several messages in a row, are answered immediately so single
+        conversations don't lose streaming or pay the grouping delay.
+        """
+        now = time.monotonic()
+        recent = self._recent_message_times.get(channel_id)
+        if recent is None:
+            recent = self._recent_message_times[channel_id] = collections.deque()
+            if len(self._recent_message_times) > BURST_TRACKED_CHANNELS:
+                self._recent_message_times.popitem(last=False) # Bounded, so it doesn't grow with every channel the bot has ever seen
+        else:
+            self._recent_message_times.move_to_end(channel_id)
+        recent.append((now, author_id))
+        while now - recent[0][0] > BURST_LOOKBACK:
+            recent.popleft()
+        return len(recent) >= BURST_THRESHOLD and len({author for _, author in recent}) > 1
+
+    async def _get_grouped_response(self, user_id: str, query: str, channel_id: str) -> str:
+        """
+        Queues a message to be answered together with any others arriving in the same channel within GROUP_DEBOUNCE.
+        """
+        pending = self._pending_groups.get(channel_id)
+        if pending is None:
+            pending = self._pending_groups[channel_id] = []
+            flush_task = asyncio.create_task(self._flush_group(channel_id, pending))
+            self._flush_tasks.add(flush_task)
+            flush_task.add_done_callback(self._flush_tasks.discard)
+        future = asyncio.get_running_loop().create_future()
+        pending.append((user_id, query, future))
+        if len(pending) >= GROUP_MAX_SIZE: # Full: the next message starts a new group
+            del self._pending_groups[channel_id]
+        return await future
+
+    async def _flush_group(self, channel_id: str, pending: list):
+        await asyncio.sleep(GROUP_DEBOUNCE)
+        if self._pending_groups.get(channel_id) is pending:
+            del self._pending_groups[channel_id]
+        try:
+            responses = [None] * len(pending)
+            if len({user_id for user_id, _, _ in pending}) > 1: # Grouping only pays off across different people
+                responses = await chatbot.get_grouped_chat_responses([(user_id, query) for user_id, query, _ in pending], channel_id)
+            # Lone messages, and any the grouped reply didn't cover, are answered on their own
+            responses = await asyncio.gather(*(
+                self._answer(response, user_id, query, channel_id) for response, (user_id, query, _) in zip(responses, pending)
+            ))
+            for (_, _, future), response in zip(pending, responses):
+                if not future.done(): # The waiter may have been cancelled; the others still get their replies
+                    future.set_result(response)
+        except Exception as e:
+            for _, _, future in pending:
+                if not future.done():
+                    future.set_exception(e)
+
+    async def _answer(self, response, user_id: str, query: str, channel_id: str) -> str:
+        if response is not None:
+            return response
+        return await self.chatbot_processor(user_id, query, channel_id, "discord")
+
     # --- Discord.py Specific Event Overrides (that don't fulfill KinechoInterface abstract methods) ---
 
     async def on_ready(self):
@@ -185,10 +357,18 @@ class DiscordInterface(KinechoInterface, discord.Client):
         """
         print(f'Logged in as {self.user} (ID: {self.user.id})')
         print('------')
+        self._mention_strs = (f'<@{self.user.id}>', f'<@!{self.user.id}>')
         # Set bot's presence
         await self.change_presence(activity=discord.Game(name="with memories"))
         print("Discord Interface: Bot is ready and presence set.")
 
+    async def on_guild_channel_delete(self, channel):
+        """
+        Overrides discord.Client.on_guild_channel_delete.
+        Forgets deleted channels so send_message doesn't keep using a stale object.
+        """
+        self._channel_cache.pop(channel.id, None)
+
     async def on_resumed(self):
         """
         Overrides discord.Client.on_resumed.
@@ -203,5 +383,6 @@ class DiscordInterface(KinechoInterface, discord.Client):
         """
         print("Discord Interface: Closing connection...")
         self.is_running = False # Set the running flag to False
+        await self.flush_pending_saves() # Make sure the last turns reached the disk
         await super().close() # Call the parent discord.Client's close method
         print("Discord Interface: Connection closed successfully.")
\ No newline at end of file
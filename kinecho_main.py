@@ -1,5 +1,8 @@
 import asyncio
+import logging
+import logging.handlers
 import os
+import queue
 import sys
 from dotenv import load_dotenv
 from typing import List, Dict, Any, Callable
@@ -7,23 +10,40 @@ from interfaces.discord_bot_interface import DiscordInterface, intents
 from interfaces.console_interface import ConsoleInterface
 import chatbot
 import memory_manager
+try:
+    import uvloop # libuv-based event loop: less overhead per callback for the Discord gateway and HTTP traffic
+except ImportError: # Optional (and not available on Windows): falls back to the default asyncio loop
+    uvloop = None
 
 load_dotenv()
 DISCORD_BOT_TOKEN = os.getenv("DISCORD_BOT_TOKEN")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY") # This isn't directly used in main, but good practice to be safe
+LOG_LEVEL = os.getenv("KINECHO_LOG_LEVEL", "INFO").upper() # Set to DEBUG in .env to see the messages sent to OpenAI, etc.
+
+# Log calls only put the record on a queue; a listener thread does the formatting and the (blocking) write to stderr,
+# so logging from a coroutine never stalls the event loop on I/O
+_log_queue = queue.SimpleQueue()
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+logging.basicConfig(level=LOG_LEVEL, handlers=[logging.handlers.QueueHandler(_log_queue)])
+log_listener = logging.handlers.QueueListener(_log_queue, _log_handler)
+logger = logging.getLogger("kinecho.main")
 
 # --- Chatbot Processor Function ---
-def kinecho_chatbot_processor(user_id: str, user_message: str, channel_id: str, interface_type: str) -> str:
+async def kinecho_chatbot_processor(user_id: str, user_message: str, channel_id: str, interface_type: str, on_delta=None) -> str:
     """
     Processes a user message using the core chatbot logic.
     This function is passed to each interface.
+    on_delta, if given, is awaited with each chunk of the response as it streams in.
     """
-    print(f"DEBUG: kinecho_chatbot_processor received: user_id={user_id}, message='{user_message}', channel_id={channel_id}, interface_type={interface_type}")
-    response = chatbot.get_chat_response(
+    logger.debug("kinecho_chatbot_processor received: user_id=%s, message='%s', channel_id=%s, interface_type=%s",
+                 user_id, user_message, channel_id, interface_type) # Formatted only if DEBUG is enabled
+    response = await chatbot.get_chat_response(
         user_id=user_id,
         prompt_text=user_message, # Renamed query to user_message for clarity
         channel_id=channel_id,
-        interface_type=interface_type
+        interface_type=interface_type,
+        on_delta=on_delta
     )
     return response
 
@@ -32,6 +52,9 @@ async def main():
     Main asynchronous function to initialize Kinecho Commander and manage interfaces.
     """
     print("Kinecho Main: Initializing Kinecho Commander...")
+    if uvloop is None and hasattr(asyncio, "eager_task_factory"): # uvloop schedules its own tasks; eager tasks are Python 3.12+
+        # New tasks run inline until they first wait on something, instead of taking a trip through the loop's ready queue
+        asyncio.get_running_loop().set_task_factory(asyncio.eager_task_factory)
 
     # Initialize interface instances (don't start them yet)
     discord_interface = DiscordInterface(
@@ -157,11 +180,13 @@ async def main():
     print("Kinecho Main: Kinecho Commander exited.")
 
 if __name__ == "__main__":
+    log_listener.start()
     try:
-        asyncio.run(main())
+        asyncio.run(main(), loop_factory=uvloop.new_event_loop if uvloop is not None else None)
     except KeyboardInterrupt:
         print("\nKinecho Main: Shutdown initiated by user via KeyboardInterrupt.")
     except Exception as e:
         print(f"Kinecho Main: An unexpected error occurred: {e}")
     finally:
+        log_listener.stop() # Writes out anything still queued
         print("Kinecho Main: Application finished.")
\ No newline at end of file
@@ -1,26 +1,86 @@
+import asyncio
 import json
+import os
 import datetime
+import logging
+import threading
+try:
+    import orjson # Several times faster than json for the whole-file load/save done every turn
+except ImportError: # Optional: falls back to the standard library
+    orjson = None
+
+logger = logging.getLogger("kinecho.memory")
 
 USER_MEMORY_FILE = "kinecho_user_memory.json"
 DM_KEY = "dm"  # Define a key to use for DMs
+MAX_CHANNEL_HISTORY_MESSAGES = 50 # How many messages per channel are kept in memory at all (keep this even so user/assistant pairs stay intact)
+EVENT_ROLES = {"message_in": "user", "message_out": "assistant"} # Event types that are part of the chat history, and their OpenAI role
 
-def load_memory():
+_memory_cache = None # Parsed memory shared by every interface in this process
+_memory_cache_mtime = None # mtime of USER_MEMORY_FILE when the cache was last loaded or saved
+_memory_lock = threading.Lock() # load_memory() may run in worker threads; only one of them should (re)build the cache
+_memory_dirty = False # Set by the mutators below; save_memory() skips the disk write while the cache is unchanged
+_memory_version = 0 # Bumped for every snapshot taken for a save
+_memory_written_version = 0 # Version of the snapshot last written, so a slow older write can't overwrite a newer one
+SAVE_COALESCE_DELAY = 0.1 # Seconds the writer waits after a save request, so turns finishing together share one write
+SAVE_MAX_RETRIES = 3 # Failed writes retried by the writer (with a growing delay) before it waits for the next request_save()
+_save_requested = asyncio.Event() # Set by request_save(), cleared by the writer once it has taken a snapshot
+_save_memory = None # Memory to write on the writer's next pass
+_writer_task = None # The single task writing USER_MEMORY_FILE for request_save(); exits when there's nothing left to save
+
+def mark_dirty():
+    """
+    Flags the in-process memory as changed since the last save.
+    Call this after mutating the memory dict directly, outside the helpers in this module.
+    """
+    global _memory_dirty
+    _memory_dirty = True
+
+def _memory_file_mtime():
     try:
-        with open(USER_MEMORY_FILE, "r") as f: # Use the new file name
-            memory = json.load(f)
+        return os.path.getmtime(USER_MEMORY_FILE)
     except FileNotFoundError:
-        memory = {} # Start with an empty dictionary if file doesn't exist
-    except json.JSONDecodeError: # Handle empty or malformed JSON
-        print(f"Warning: {USER_MEMORY_FILE} is empty or corrupted. Starting with fresh memory.")
-        memory = {}
+        return None
 
-    # Ensure the top-level "users" key exists
-    if "users" not in memory:
-        memory["users"] = {}
-    # You might also want to ensure global_system_memory exists here or load it separately
-    # For now, let's keep it simple with just users in this file. 
-    # I *do* intend to add it to this file, to be clear.
-    return memory
+def load_memory():
+    """
+    Returns the in-process memory, only re-reading USER_MEMORY_FILE if it changed on disk
+    since we last loaded or saved it (e.g. it was edited by hand).
+    Callers share the returned dict, so mutations are visible to every interface.
+    """
+    global _memory_cache, _memory_cache_mtime, _memory_dirty
+    with _memory_lock:
+        mtime = _memory_file_mtime()
+        if _memory_cache is not None and mtime == _memory_cache_mtime:
+            return _memory_cache
+
+        try:
+            if orjson is not None:
+                with open(USER_MEMORY_FILE, "rb") as f: # Use the new file name
+                    memory = orjson.loads(f.read())
+            else:
+                with open(USER_MEMORY_FILE, "r") as f:
+                    memory = json.load(f)
+        except FileNotFoundError:
+            memory = {} # Start with an empty dictionary if file doesn't exist
+        except json.JSONDecodeError: # Handle empty or malformed JSON (orjson's error subclasses this one)
+            logger.warning("%s is empty or corrupted. Starting with fresh memory.", USER_MEMORY_FILE)
+            memory = {}
+
+        # Ensure the top-level "users" key exists
+        if "users" not in memory:
+            memory["users"] = {}
+        # Older memory files only have the raw event stream; index it by channel once so history lookups are a slice
+        for user_data in memory["users"].values():
+            if "channels" not in user_data:
+                user_data["channels"] = _build_channels_from_events(user_data.get("events", []))
+                _memory_dirty = True # Persist the migration on the next save
+        # You might also want to ensure global_system_memory exists here or load it separately
+        # For now, let's keep it simple with just users in this file. 
+        # I *do* intend to add it to this file, to be clear.
+        _memory_cache = memory
+        _memory_cache_mtime = mtime
+        return memory
 
 def create_or_get_user(memory: dict, user_id: str, user_name: str, interface_type: str, discord_id: str = None) -> dict:
     """
@@ -39,8 +99,10 @@ def create_or_get_user(memory: dict, user_id: str, user_name: str, interface_typ
                 "created_at": datetime.datetime.now().isoformat()
             },
             "events": [],
+            "channels": {},
             "derived_facts": []
         }
+        mark_dirty()
     else:
         # User exists, ensure 'profile' dictionary exists and update the 'name'
         user_profile = memory["users"][user_id].get("profile", {})
@@ -48,11 +110,17 @@ def create_or_get_user(memory: dict, user_id: str, user_name: str, interface_typ
             memory["users"][user_id]["profile"] = {}
             user_profile = memory["users"][user_id]["profile"]
 
-        user_profile["name"] = user_name
+        # Only touch the profile (and mark memory dirty) when something actually changed
+        if user_profile.get("name") != user_name:
+            user_profile["name"] = user_name
+            mark_dirty()
         # Also update other profile details in case they changed or were missing
-        user_profile["interface_type"] = interface_type
-        if discord_id:
+        if user_profile.get("interface_type") != interface_type:
+            user_profile["interface_type"] = interface_type
+            mark_dirty()
+        if discord_id and user_profile.get("discord_id") != discord_id:
             user_profile["discord_id"] = discord_id
+            mark_dirty()
 
     return memory["users"][user_id]
 
@@ -62,10 +130,11 @@ def add_user_event(memory: dict, user_id: str, event_type: str, channel_id: str,
     """
     if user_id not in memory["users"]:
         # This should ideally not happen if create_or_get_user is called first
-        print(f"Warning: User {user_id} not found when trying to add event. Creating temporary entry.")
+        logger.warning("User %s not found when trying to add event. Creating temporary entry.", user_id)
         memory["users"][user_id] = {
             "profile": {"name": f"Unknown {user_id}", "interface_type": source},
             "events": [],
+            "channels": {},
             "derived_facts": []
         }
     user_events = memory["users"][user_id]["events"]
@@ -77,28 +146,183 @@ def add_user_event(memory: dict, user_id: str, event_type: str, channel_id: str,
         "source": source
     }
     user_events.append(event)
+    mark_dirty()
     # We can implement a pruning strategy for events later if the list grows too large
     # For now, let's allow it to grow.
 
+def _serialize_memory(memory) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(memory, option=orjson.OPT_INDENT_2) # Still indented so the file stays readable
+    return json.dumps(memory, indent=4).encode("utf-8")
+
+def _write_memory_file(memory, data: bytes, version: int):
+    global _memory_cache, _memory_cache_mtime, _memory_written_version
+    # Under the same lock as load_memory(), so a reload can't see our write before the cached mtime is updated
+    with _memory_lock:
+        if version <= _memory_written_version:
+            return # A newer snapshot already reached the disk
+        temp_file = USER_MEMORY_FILE + ".tmp"
+        with open(temp_file, "wb") as f:
+            f.write(data)
+        os.replace(temp_file, USER_MEMORY_FILE) # Atomic, so a crash mid-write can't leave a truncated file that the next load discards
+        # Our own write shouldn't force the next load_memory() to re-parse the file
+        _memory_cache = memory
+        _memory_cache_mtime = _memory_file_mtime()
+        _memory_written_version = version
+
+def _take_snapshot(memory):
+    """
+    Serializes memory for a save and clears the dirty flag, or returns None if there is nothing to write.
+    """
+    global _memory_dirty, _memory_version
+    if memory is _memory_cache and not _memory_dirty:
+        return None # Nothing to write: re-serializing an unchanged file is pure disk churn
+    data = _serialize_memory(memory)
+    _memory_dirty = False
+    _memory_version += 1
+    return data, _memory_version
+
 def save_memory(memory):
-    with open(USER_MEMORY_FILE, "w") as f:
-        json.dump(memory, f, indent=4)
+    """
+    Writes memory to USER_MEMORY_FILE, unless it is the in-process memory and nothing has changed since the last save.
+    """
+    snapshot = _take_snapshot(memory)
+    if snapshot is not None:
+        _write_memory_file(memory, *snapshot)
+
+async def save_memory_async(memory):
+    """
+    Like save_memory(), but only serializes on the calling (event loop) thread and does the file write in a worker thread.
+    Serializing first means the loop can keep mutating memory while the write is in progress.
+    """
+    snapshot = _take_snapshot(memory)
+    if snapshot is None:
+        return
+    try:
+        await asyncio.to_thread(_write_memory_file, memory, *snapshot)
+    except Exception:
+        mark_dirty() # The snapshot never made it to disk; let the next save retry
+        raise
+
+def request_save(memory):
+    """
+    Asks the writer task to save memory soon, without waiting for it. Requests arriving within SAVE_COALESCE_DELAY
+    of each other (e.g. from several Discord channels) are folded into one write, and only one write runs at a time.
+    Call flush_saves() before shutting down.
+    """
+    global _save_memory, _writer_task
+    _save_memory = memory
+    _save_requested.set()
+    if _writer_task is None or _writer_task.done():
+        _writer_task = asyncio.create_task(_writer_loop())
+
+async def _writer_loop():
+    failures = 0
+    while _save_requested.is_set():
+        await asyncio.sleep(SAVE_COALESCE_DELAY * 2 ** failures)
+        _save_requested.clear() # Requests from here on need another pass; this one's snapshot is taken below
+        try:
+            await save_memory_async(_save_memory)
+            failures = 0
+        except Exception as e:
+            failures += 1
+            logger.exception("Failed to save memory to %s (attempt %d): %s", USER_MEMORY_FILE, failures, e)
+            if failures <= SAVE_MAX_RETRIES:
+                _save_requested.set() # save_memory_async() marked memory dirty again; try another pass
+            else:
+                logger.error("Giving up on saving memory for now; it stays unsaved until the next save.")
 
-def get_channel_memory(memory, channel_id):
+async def flush_saves() -> bool:
+    """
+    Waits until every save asked for with request_save() has been written, making one last attempt if the writer gave up.
+    Returns False (after logging it) if memory still has unsaved changes.
+    """
+    if _writer_task is not None and not _writer_task.done():
+        await _writer_task
+    if _memory_dirty and _save_memory is not None:
+        try:
+            await save_memory_async(_save_memory)
+        except Exception as e:
+            logger.exception("Failed to save memory to %s: %s", USER_MEMORY_FILE, e)
+    if _memory_dirty:
+        logger.error("Memory has unsaved changes that could not be written to %s.", USER_MEMORY_FILE)
+        return False
+    return True
+
+def _build_channels_from_events(user_events: list) -> dict:
+    """
+    Rebuilds per-channel, OpenAI-ready message histories from a user's event stream.
+    Only used to migrate memory files written before channel histories were stored.
+    """
+    channel_messages = {}
+    for event in user_events:
+        role = EVENT_ROLES.get(event["type"]) # One dict lookup instead of an if/elif chain per event
+        if role is not None:
+            channel_messages.setdefault(event["channel_id"], []).append({"role": role, "content": event["content"]})
+    return {channel_id: {"messages": messages} for channel_id, messages in channel_messages.items()}
+
+def get_channel_memory(memory: dict, user_id: str, channel_id: str) -> list:
+    """
+    Returns a user's conversation history for a channel as a list of {"role", "content"} dicts,
+    already in the shape the OpenAI API expects.
+    """
     channel_key = DM_KEY if channel_id is None else str(channel_id)
-    return memory.get(channel_key, [])
+    user_data = memory.get("users", {}).get(user_id, {})
+    return user_data.get("channels", {}).get(channel_key, {}).get("messages", [])
 
-def update_channel_memory(memory, channel_id, new_data):
+def update_channel_memory(memory: dict, user_id: str, channel_id: str, new_data: list,
+                          max_messages: int = MAX_CHANNEL_HISTORY_MESSAGES):
+    """
+    Appends user/assistant messages to a user's conversation history for a channel.
+    Call this once the chatbot has answered, so the pending prompt is never part of its own history.
+    The stored history is trimmed here, at write time, to the most recent max_messages entries.
+    """
     channel_key = DM_KEY if channel_id is None else str(channel_id)
-    if channel_key not in memory:
-        memory[channel_key] = []
-    formatted_data = []
+    channels = memory["users"][user_id].setdefault("channels", {})
+    channel_messages = channels.setdefault(channel_key, {"messages": []})["messages"]
     for item in new_data:
-        if item["role"] == "user":
-            formatted_data.append({"role": "user", "content": item["content"]})
-        elif item["role"] == "assistant":
-            formatted_data.append({"role": "assistant", "content": item["content"]})
-    memory[channel_key].extend(formatted_data)
-    if len(memory[channel_key]) > 20:  # Keep a maximum of 20 entries
-        memory[channel_key] = memory[channel_key][-20:]
-    save_memory(memory)
\ No newline at end of file
+        if item["role"] in ("user", "assistant"):
+            channel_messages.append({"role": item["role"], "content": item["content"]})
+    if len(channel_messages) > max_messages:  # Drop the oldest entries so the stored list never grows unbounded
+        del channel_messages[:-max_messages] # In place, like a bounded deque, rather than copying the kept tail into a new list
+    mark_dirty()
+
+def get_channel_summary(memory: dict, user_id: str, channel_id: str) -> str:
+    """
+    Returns the running summary of a user's older conversation in a channel, or "" if nothing has been compacted yet.
+    """
+    channel_key = DM_KEY if channel_id is None else str(channel_id)
+    user_data = memory.get("users", {}).get(user_id, {})
+    return user_data.get("channels", {}).get(channel_key, {}).get("summary", "")
+
+def compact_channel_memory(memory: dict, user_id: str, channel_id: str, count: int, summary: str):
+    """
+    Replaces the oldest count messages of a user's channel history with summary,
+    which then stands in for everything compacted so far.
+    """
+    channel_key = DM_KEY if channel_id is None else str(channel_id)
+    channel = memory["users"][user_id]["channels"][channel_key]
+    del channel["messages"][:count]
+    channel["summary"] = summary
+    mark_dirty()
+
+def record_user_turn(memory: dict, *, user_id: str, user_name: str, channel_id: str, interface_type: str, content: str,
+                     discord_id: str = None):
+    """
+    Records an incoming message: makes sure the user exists, then adds the message_in event.
+    The channel history is only updated by record_bot_turn(), once the prompt has been answered.
+    """
+    create_or_get_user(memory, user_id, user_name, interface_type, discord_id=discord_id)
+    add_user_event(memory, user_id, "message_in", channel_id, content, interface_type)
+
+def record_bot_turn(memory: dict, *, user_id: str, channel_id: str, interface_type: str, query: str, response: str,
+                    sent_content: str = None, max_messages: int = MAX_CHANNEL_HISTORY_MESSAGES):
+    """
+    Records the reply to a message: adds the message_out event (sent_content if given, i.e. exactly what was sent),
+    then appends the query and response to the channel history replayed in later turns.
+    """
+    add_user_event(memory, user_id, "message_out", channel_id, response if sent_content is None else sent_content, interface_type)
+    update_channel_memory(memory, user_id, channel_id, [
+        {"role": "user", "content": query},
+        {"role": "assistant", "content": response}
+    ], max_messages=max_messages)